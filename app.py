@@ -1,29 +1,74 @@
-from flask import Flask, jsonify, request
+from flask import Flask, jsonify, request, stream_with_context
+from flask.json.provider import JSONProvider
 # Flask class - gives us all the tools we need to create a Flask application (web application) by creating an instance of the Flask class
 # jsonify - Converts data into JSON format
 # requests - allows us to interact with HTTP method requests as objects
+# stream_with_context - keeps the request (and our database session) alive while a response is streamed out
+# JSONProvider - the class Flask uses to turn data into JSON and back, we swap in our own to use orjson
 from flask_sqlalchemy import SQLAlchemy
 # SQLALchemy - ORM to connect and relate Python classes to database tables
-from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, selectinload, raiseload
 # DeclarativeBase - gives us the base model functionality to create classes as models for our database tables, also track the metadata for our tables and classes
 # Mapped - Maps a class attribute to a table column (or relationship)
 # mapped_column - sets our columns and allows us to add any constraints we might need (unique, nullable, primary_key)
+# selectinload - loader option that fetches a relationship up front with one extra SELECT ... WHERE id IN (...) query
+# raiseload - loader option that raises an error if a relationship we didn't ask for gets lazy loaded
 from flask_marshmallow import Marshmallow
 # Marshmallow - allows us to create schema to validate, serialize, and deserialize JSON data
+from flask_compress import Compress
+# Compress - gzips responses for clients that accept it, so large JSON lists send far fewer bytes
 from datetime import date
 # datetime - allows us to create datetime objects
 from typing import List
 # List - is used to create a relationship that will return a list of objects
 from marshmallow import ValidationError, fields
 # fields - lets us set a schema field which includes data types and constraints
-from sqlalchemy import select, delete
+from sqlalchemy import select, delete, insert, update, bindparam
 # select - acts as our SELECT FROM query
 # delete - act as our DELETE query
+# update - acts as our UPDATE query
+# bindparam - a named placeholder in a query, so the query can be built once and given its values when it runs
+# insert - acts as our INSERT INTO query, and can insert a whole list of rows at once
+from sqlalchemy.exc import IntegrityError
+# IntegrityError - raised when the database rejects a row, like a missing value for a NOT NULL column
+from sqlalchemy.pool import NullPool
+# NullPool - a "pool" that opens a brand new connection every time, for environments that manage connections themselves
+import os
+# os - lets us read environment variables
+import orjson
+# orjson - a JSON library written in Rust, much faster than Python's built in json module
+import zlib
+# zlib - lets us gzip a streamed response one piece at a time
 
 
 app = Flask(__name__) # creating an instance of the Flask class for our app to use
 
-app.config['SQLALCHEMY_DATABASE_URI'] = 'mysql+mysqlconnector://root:@localhost/ecom'
+class OrjsonProvider(JSONProvider):
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option= orjson.OPT_NON_STR_KEYS).decode() # OPT_NON_STR_KEYS allows integer keys, like the row numbers in a many= True ValidationError
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s) # request.json hands us the raw request bytes, which orjson parses directly without decoding them to a string first
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, option= orjson.OPT_NON_STR_KEYS), mimetype= 'application/json') # orjson already gives us bytes, so skip converting to a string and back
+
+app.json = OrjsonProvider(app) # jsonify() and request.json now use orjson, request.json is parsed once and that dictionary goes straight into schema.load()
+
+app.config['SQLALCHEMY_DATABASE_URI'] = 'mysql+mysqldb://root:@localhost/ecom' # mysqldb is the mysqlclient driver, written in C so it reads rows much faster than mysql-connector-python
+
+# Keep a pool of open database connections to reuse across requests instead of connecting to MySQL every time
+if os.getenv('SQLALCHEMY_NULLPOOL'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'poolclass': NullPool}
+else:
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': 10, # connections kept open in the pool
+        'max_overflow': 20, # extra connections allowed when the pool is busy
+        'pool_pre_ping': True, # check a connection is still alive before using it
+        'pool_recycle': 1800, # replace connections older than 30 minutes, before MySQL times them out
+        'pool_use_lifo': True # reuse the most recently returned connection first
+    }
 
 class Base(DeclarativeBase):
     pass
@@ -31,8 +76,19 @@ class Base(DeclarativeBase):
 db = SQLAlchemy(app, model_class= Base)
 ma = Marshmallow(app)
 
+app.config['COMPRESS_MIMETYPES'] = ['application/json'] # only compress our JSON responses
+app.config['COMPRESS_ALGORITHM'] = 'gzip' # gzip is understood by every client
+app.config['COMPRESS_LEVEL'] = 4 # a lower gzip level, most of the size savings for less CPU time
+app.config['COMPRESS_MIN_SIZE'] = 512 # small responses aren't worth compressing
+app.config['COMPRESS_STREAMS'] = False # Flask-Compress would read a whole streamed list into memory before compressing it, stream_json_list gzips its own output instead
+Compress(app)
+
 #================= Models (tables as classes) (using SQLAlchemy) =================#
 
+# Loader policy: relationships below only declare how the tables connect (back_populates, secondary).
+# How a relationship gets loaded is decided by each query - list endpoints use raiseload('*') so nothing
+# lazy loads one row at a time, and queries that need a relationship ask for it with selectinload().
+
 class Customer(Base):
     __tablename__ = "customer" # make you class name the same as your table name, and the table name should be exactly as it is in your database
 
@@ -50,7 +106,8 @@ order_products = db.Table(
     "order_products",
     Base.metadata, # allows this table to locate foreign keys from the Base class
     db.Column('order_id', db.ForeignKey('orders.id'), primary_key= True),
-    db.Column('product_id', db.ForeignKey('products.id'), primary_key= True)
+    db.Column('product_id', db.ForeignKey('products.id'), primary_key= True),
+    db.Index('ix_order_products_product', 'product_id') # the primary key (order_id, product_id) already covers lookups by order_id, this covers lookups by product_id
 )
 
 
@@ -59,7 +116,7 @@ class Orders(Base):
 
     id: Mapped[int] = mapped_column(primary_key= True)
     order_date: Mapped[date] = mapped_column(db.Date, nullable= False)
-    customer_id: Mapped[int] = mapped_column(db.ForeignKey('customer.id'))
+    customer_id: Mapped[int] = mapped_column(db.ForeignKey('customer.id'), index= True) # index= True so finding a customer's orders doesn't scan the whole table
 
     # create a many-one relationship to the Customer table
     customer: Mapped['Customer'] = db.relationship(back_populates= 'orders')
@@ -78,6 +135,9 @@ class Products(Base):
 
 with app.app_context():
     # db.drop_all() # drops (deletes) all tables in the database
+    # create_all() won't add these indexes to tables that already exist, for an existing database run:
+    # CREATE INDEX ix_orders_customer_id ON orders (customer_id);
+    # CREATE INDEX ix_order_products_product ON order_products (product_id);
     db.create_all() # First checks to see if a table already exists, and then creates the tables it couldn't find, if it finds a table with the same name it doesn't reconstruct or modify it.
 
 
@@ -97,6 +157,7 @@ class OrderSchema(ma.Schema):
     id = fields.Integer(required= False)
     order_date = fields.Date(required= False)
     customer_id = fields.Integer(required= True)
+    items = fields.List(fields.Integer(), required= True) # declared here so it's set up once with the class, instead of being guessed as a plain field from Meta.fields
 
     class Meta:
         fields = ('id', 'order_date', 'customer_id', 'items') # items will be a list of product id's associated with an order
@@ -109,6 +170,8 @@ class ProductSchema(ma.Schema):
     class Meta:
         fields = ('id', 'product_name', 'price')
 
+# Schemas are created once here and reused by every request - creating a schema rebuilds its fields, so never create one inside a route
+# .load() validates incoming data, .dump()/.jsonify() only serialize (no validation), so a response never pays for validation twice (GET routes skip the schemas entirely, see Read Serializers below)
 customer_schema = CustomerSchema()
 customers_schema = CustomerSchema(many= True)
 
@@ -119,6 +182,58 @@ product_schema = ProductSchema()
 products_schema = ProductSchema(many= True)
 
 
+#=============== Prebuilt Queries ==================#
+
+# Queries that are the same on every request are built once here instead of inside each route,
+# the values that change per request are bindparam placeholders filled in when the query runs
+all_customers_query = select(Customer).options(raiseload('*')).execution_options(yield_per= 500) # SELECT * FROM customer, fetched 500 rows at a time, with no lazy loading of relationships (add selectinload(Customer.orders) here if customer_to_dict ever includes orders)
+all_products_query = select(Products).options(raiseload('*')).execution_options(yield_per= 500)
+existing_product_ids_query = select(Products.id).where(Products.id.in_(bindparam('ids', expanding= True))) # SELECT id FROM products WHERE id IN (...), expanding= True lets one placeholder take a whole list
+existing_customer_ids_query = select(Customer.id).where(Customer.id.in_(bindparam('ids', expanding= True)))
+delete_customer_query = delete(Customer).where(Customer.id == bindparam('id')) # DELETE FROM customer WHERE id == id
+
+
+#=============== Read Serializers ==================#
+
+# Data read from our own database doesn't need validating, so GET routes turn rows into dictionaries by hand
+# instead of running them through a Marshmallow schema field by field. Marshmallow is still used to load (validate) incoming data.
+# Keep these matching the fields in the schemas above.
+def customer_to_dict(customer):
+    return {'id': customer.id, 'customer_name': customer.customer_name, 'email': customer.email, 'phone': customer.phone}
+
+def product_to_dict(product):
+    return {'id': product.id, 'product_name': product.product_name, 'price': product.price}
+
+
+# Streams a JSON list one row at a time, so the whole table never has to sit in memory as a list, a list of dicts, and a big string at once
+def stream_json_list(query, to_dict):
+    def generate():
+        rows = db.session.execute(query).scalars() # the query runs inside the stream, because the session from the view is closed by the time the response is sent
+        yield b'['
+        for i, row in enumerate(rows):
+            if i > 0:
+                yield b','
+            yield orjson.dumps(to_dict(row))
+        yield b']'
+
+    def generate_gzip():
+        compressor = zlib.compressobj(app.config['COMPRESS_LEVEL'], zlib.DEFLATED, 31) # wbits= 31 writes gzip headers, so the client sees a normal gzip response
+        for chunk in generate():
+            compressed = compressor.compress(chunk)
+            if compressed: # zlib holds on to small pieces until it has enough to compress
+                yield compressed
+        yield compressor.flush()
+
+    if request.accept_encodings['gzip']: # the client sent Accept-Encoding: gzip
+        response = app.response_class(stream_with_context(generate_gzip()), mimetype= 'application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = app.response_class(stream_with_context(generate()), mimetype= 'application/json')
+
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+
 @app.route('/')
 def home():
     return "Welcome to this wild ride on the Flask SQLAlchemy rollercoaster!"
@@ -137,22 +252,17 @@ Delete (DELETE)
 # get all customer using a GET method
 @app.route("/customers", methods= ['GET'])
 def get_customers():
-    query = select(Customer) # SELECT * FROM customer
-    result = db.session.execute(query).scalars() # Execute our query, and convert each row object into a scalar object (python useable)
-    customers = result.all() # pack all objects into a list
-
-    return customers_schema.jsonify(customers)
+    return stream_json_list(all_customers_query, customer_to_dict)
 
 # Get a single customer with a GET method, dynamic route
 @app.route('/customers/<int:id>', methods= ['GET'])
 def get_customer(id):
-    query = select(Customer).where(Customer.id == id)
-    result = db.session.execute(query).scalars().first() # .first() simple grabs the first object from the data returned from execute()
+    result = db.session.get(Customer, id) # looks up a row by its primary key, reusing the object if this session already loaded it
 
     if result is None:
         return jsonify({'Error': "Customer not found!"}), 404
     
-    return customer_schema.jsonify(result)
+    return jsonify(customer_to_dict(result))
 
 
 # Create a customer with a POST request
@@ -163,29 +273,49 @@ def add_customer():
     except ValidationError as e:
         return jsonify(e.messages), 400
     
-    new_customer = Customer(customer_name= customer_data['customer_name'], email= customer_data['email'], phone= customer_data['phone'])
-    db.session.add(new_customer)
+    query = insert(Customer).values(customer_name= customer_data['customer_name'], email= customer_data['email'], phone= customer_data['phone'])
+    result = db.session.execute(query)
+    new_id = result.inserted_primary_key[0] # MySQL has no RETURNING, the new id comes back with the INSERT itself (no follow up SELECT needed)
     db.session.commit()
 
-    return jsonify({'Message': "New customer added successfully!"}), 201
+    return jsonify({'id': new_id, 'Message': "New customer added successfully!"}), 201
+
+
+# Create many customers at once with a POST request, sending a JSON list of customers
+@app.route("/customers/bulk", methods= ['POST'])
+def add_customers_bulk():
+    try:
+        customers_data = customers_schema.load(request.json) # many= True, so this validates every customer in the list
+    except ValidationError as e:
+        return jsonify(e.messages), 400
+
+    if not customers_data:
+        return jsonify({'Error': "No customers provided!"}), 400
+
+    try:
+        db.session.execute(insert(Customer), customers_data) # one INSERT for the whole list instead of one per customer
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback() # nothing from the list is saved
+        return jsonify({'Error': "Customers could not be saved, every customer needs an email and phone, and any id given can't already exist!"}), 400
+
+    return jsonify({'Message': "New customers added successfully!", 'count': len(customers_data)}), 201
 
 
 # Update a customer with a PUT request
 @app.route("/customers/<int:id>", methods= ['PUT'])
 def update_customer(id):
-    query = select(Customer).where(Customer.id == id)
-    result = db.session.execute(query).scalar()
-    if result is None:
-        return jsonify({"Error": "Customer not found"}), 404
-    
-    customer = result
     try:
         customer_data = customer_schema.load(request.json)
     except ValidationError as e:
         return jsonify(e.messages), 400
-    
-    for field, value in customer_data.items(): # taking each item in our JSON dictionary object, looking at each key-value pair and updating our customer object's attributes
-        setattr(customer, field, value)
+
+    query = update(Customer).where(Customer.id == id).values(**customer_data) # UPDATE customer SET ... WHERE id == id, using each key-value pair in our JSON dictionary object
+
+    result = db.session.execute(query)
+
+    if result.rowcount == 0:
+        return jsonify({"Error": "Customer not found"}), 404
 
     db.session.commit()
     return jsonify({"Message": "Customer details have been updated"})
@@ -193,9 +323,7 @@ def update_customer(id):
 # Delete a customer with a DELETE request
 @app.route("/customers/<int:id>", methods= ['DELETE'])
 def delete_customer(id):
-    query = delete(Customer).where(Customer.id == id) # DELETE FROM customer WHERE id == id
-
-    result = db.session.execute(query)
+    result = db.session.execute(delete_customer_query, {'id': id})
 
     if result.rowcount == 0:
         return jsonify({"Message": "Customer not found!"}), 404
@@ -213,20 +341,36 @@ def add_product():
     except ValidationError as e:
         return jsonify(e.messages), 400
     
-    new_product = Products(product_name= product_data['product_name'], price= product_data['price'])
-    db.session.add(new_product)
+    query = insert(Products).values(product_name= product_data['product_name'], price= product_data['price'])
+    result = db.session.execute(query)
+    new_id = result.inserted_primary_key[0]
     db.session.commit()
 
-    return jsonify({"Message": "New product added successfully!"}), 201
+    return jsonify({'id': new_id, "Message": "New product added successfully!"}), 201
 
-@app.route("/products", methods=['GET'])
-def get_products():
-    query = select(Products)
-    result = db.session.execute(query).scalars()
+# Create many products at once with a POST request, sending a JSON list of products
+@app.route("/products/bulk", methods=['POST'])
+def add_products_bulk():
+    try:
+        products_data = products_schema.load(request.json)
+    except ValidationError as e:
+        return jsonify(e.messages), 400
+
+    if not products_data:
+        return jsonify({"Error": "No products provided!"}), 400
 
-    products = result.all()
+    try:
+        db.session.execute(insert(Products), products_data)
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback() # nothing from the list is saved
+        return jsonify({"Error": "Products could not be saved, any id given can't already exist!"}), 400
 
-    return products_schema.jsonify(products)
+    return jsonify({"Message": "New products added successfully!", 'count': len(products_data)}), 201
+
+@app.route("/products", methods=['GET'])
+def get_products():
+    return stream_json_list(all_products_query, product_to_dict)
 
 #============= Order Interactions ===============#
 
@@ -240,23 +384,81 @@ def add_order():
     
     new_order = Orders(order_date= date.today(), customer_id= order_data['customer_id'])
 
-    for item_id in order_data['items']:
-        query = select(Products).where(Products.id == item_id)
-        item = db.session.execute(query).scalar()
-        new_order.products.append(item)
+    item_ids = list(order_data['items'])
+    existing_ids = set(db.session.execute(existing_product_ids_query, {'ids': item_ids}).scalars().all()) # one query for every item instead of one query per item
+
+    missing_ids = set(item_ids) - existing_ids # any product id's that didn't come back don't exist
+    if missing_ids:
+        return jsonify({"Error": "Unknown product ids", 'ids': sorted(missing_ids)}), 400
 
     db.session.add(new_order)
+    db.session.flush() # sends the new order to the database so new_order.id gets filled in, without committing yet
+    new_id = new_order.id # read the id before commit(), after commit() the order is expired and reading it would SELECT it again
+
+    # INSERT INTO order_products with one row per product, in a single statement instead of one INSERT per product
+    order_product_rows = [{'order_id': new_id, 'product_id': product_id} for product_id in dict.fromkeys(item_ids)]
+    if order_product_rows: # an empty list would run the INSERT once with no values instead of skipping it
+        db.session.execute(order_products.insert(), order_product_rows)
     db.session.commit()
-    return jsonify({"Message": "New order placed!"}), 201
+    return jsonify({'id': new_id, "Message": "New order placed!"}), 201
+
+# Place many orders at once with a POST request, sending a JSON list of orders
+@app.route("/orders/bulk", methods=['POST'])
+def add_orders_bulk():
+    try:
+        orders_data = orders_schema.load(request.json)
+    except ValidationError as e:
+        return jsonify(e.messages), 400
+
+    if not orders_data:
+        return jsonify({"Error": "No orders provided!"}), 400
+
+    item_ids = {item_id for order in orders_data for item_id in order['items']} # every product id used by any of the orders
+    existing_ids = set(db.session.execute(existing_product_ids_query, {'ids': list(item_ids)}).scalars().all())
+
+    missing_ids = item_ids - existing_ids
+    if missing_ids:
+        return jsonify({"Error": "Unknown product ids", 'ids': sorted(missing_ids)}), 400
+
+    customer_ids = {order['customer_id'] for order in orders_data} # same check for the customers, in one query
+    existing_ids = set(db.session.execute(existing_customer_ids_query, {'ids': list(customer_ids)}).scalars().all())
+
+    missing_ids = customer_ids - existing_ids
+    if missing_ids:
+        return jsonify({"Error": "Unknown customer ids", 'ids': sorted(missing_ids)}), 400
+
+    try:
+        new_orders = [Orders(order_date= date.today(), customer_id= order['customer_id']) for order in orders_data]
+        db.session.add_all(new_orders)
+        db.session.flush() # MySQL has no RETURNING, so the orders are flushed to fill in each new_order.id
+
+        # one INSERT into order_products for the products of every order
+        order_product_rows = [
+            {'order_id': new_order.id, 'product_id': product_id}
+            for new_order, order in zip(new_orders, orders_data)
+            for product_id in dict.fromkeys(order['items'])
+        ]
+        if order_product_rows:
+            db.session.execute(order_products.insert(), order_product_rows)
+        db.session.commit()
+    except IntegrityError: # e.g. a customer or product deleted between the checks above and the INSERT
+        db.session.rollback() # none of the orders are saved
+        return jsonify({"Error": "Orders could not be saved, check the customer and product ids!"}), 400
+
+    return jsonify({"Message": "New orders placed!", 'count': len(new_orders)}), 201
 
 # Get items in an order by order ID
 @app.route("/order_items/<int:id>", methods=['GET'])
 def order_items(id):
-    query = select(Orders).where(Orders.id == id)
-    order = db.session.execute(query).scalar()
+    order = db.session.get(Orders, id, options= [selectinload(Orders.products), raiseload('*')]) # load the order's products with the order, and block any other relationship from lazy loading
+
+    if order is None:
+        return jsonify({"Error": "Order not found!"}), 404
 
-    return products_schema.jsonify(order.products)
+    return jsonify([product_to_dict(product) for product in order.products])
 
 
-if __name__ == "__main__":
+# app.run() is Flask's single threaded development server, only use it while developing (FLASK_DEV=1 python app.py)
+# In production run the app with gunicorn so requests are handled in parallel: gunicorn -w 4 -k gthread --threads 8 app:app
+if __name__ == "__main__" and os.getenv('FLASK_DEV'):
     app.run(debug= True)
\ No newline at end of file